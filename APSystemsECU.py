@@ -2,7 +2,6 @@
 
 import asyncio
 import socket
-import binascii
 import datetime
 import json
 import logging
@@ -11,23 +10,20 @@ _LOGGER = logging.getLogger(__name__)
 
 from pprint import pprint
 
-class APSystemsInvalidData(Exception):
-    pass
-
-class APSystemsInvalidInverter(Exception):
-    pass
+from APSystemsProtocol import APSystemsProtocol, APSystemsInvalidData, APSystemsInvalidInverter
 
 
 class APSystemsECU:
 
-    def __init__(self, ip_addr, port=8899, raw_ecu=None, raw_inverter=None):
+    def __init__(self, ip_addr, port=8899, raw_ecu=None, raw_inverter=None, trace=None):
         self.ip_addr = ip_addr
         self.port = port
 
-        # what do we expect socket data to end in
-        self.recv_suffix = b'END\n'
+        # command building, framing and parsing live in the sans-IO core,
+        # this class only moves bytes between it and the socket
+        self.protocol = APSystemsProtocol(trace)
 
-        # how long to wait on socket commands until we get our recv_suffix
+        # overall deadline of one command: connect, write and reading the response
         self.timeout = 5
 
         # how many times do we try the same command in a single update before failing
@@ -35,18 +31,10 @@ class APSystemsECU:
 
         # how big of a buffer to read at a time from the socket
         self.recv_size = 1024
+        self.recv_buffer = bytearray(self.recv_size)
 
         # how long to wait between socket open/closes
         self.socket_sleep_time = 2.0
-        self.cmd_suffix = "END\n"
-        self.ecu_query = "APS1100160001" + self.cmd_suffix
-        self.inverter_query_prefix = "APS1100280002"
-        self.inverter_query_suffix = self.cmd_suffix
-
-        self.inverter_signal_prefix = "APS1100280030"
-        self.inverter_signal_suffix = self.cmd_suffix
-
-        self.inverter_byte_start = 26
 
         self.ecu_id = None
         self.ecu_firmware = None
@@ -66,311 +54,173 @@ class APSystemsECU:
         self.inverter_raw_data = raw_inverter
         self.inverter_raw_signal = None
 
-        self.read_buffer = b''
-
-        self.reader = None
-        self.writer = None
-
+        self.sock = None
         self.socket_open = False
 
+        # what the current command is doing, reported when it times out
+        self.stage = None
+
         self.errors = []
 
     async def async_read_from_socket(self):
-        self.read_buffer = b''
-        end_data = None
-
-        self.read_buffer = await self.reader.readline()
-        if self.read_buffer == b'':
-            error = f"Got empty string from socket"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        size = len(self.read_buffer)
-        end_data = self.read_buffer[size-4:]
-        if end_data != self.recv_suffix:
-            error = f"End suffix ({self.recv_suffix}) missing from ECU response end_data={end_data} data={self.read_buffer}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        return self.read_buffer
+        loop = asyncio.get_running_loop()
+        if len(self.recv_buffer) != self.recv_size:
+            self.recv_buffer = bytearray(self.recv_size)
+        view = memoryview(self.recv_buffer)
+        while True:
+            frame = self.protocol.next_frame()
+            if frame is not None:
+                return frame
+
+            size = await loop.sock_recv_into(self.sock, view)
+            if size == 0:
+                error = f"Got empty string from socket"
+                raise APSystemsInvalidData(error)
+            self.protocol.receive_data(view[:size])
 
     async def async_send_read_from_socket(self, cmd):
-        self.writer.write(cmd.encode('utf-8'))
-        await self.writer.drain()
-        try:
-            return await asyncio.wait_for(self.async_read_from_socket(), timeout=self.timeout)
-        except asyncio.TimeoutError as err:
-            await self.async_close_socket()
-            msg = "Timeout after {self.timeout}s waiting or ECU data cmd={cmd.rstrip()}. Closing socket."
-            self.add_error(msg)
-            raise APSystemsInvalidData(msg)
+        self.protocol.reset()
+        self.stage = "write"
+        await asyncio.get_running_loop().sock_sendall(self.sock, cmd)
+        self.stage = "read"
+        return await self.async_read_from_socket()
 
     async def async_close_socket(self):
-        if self.socket_open:
-            self.writer.close()
-            await self.writer.wait_closed()
-            self.socket_open = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.socket_open = False
 
     async def async_open_socket(self):
+        loop = asyncio.get_running_loop()
         _LOGGER.debug(f"Connecting to ECU on {self.ip_addr} {self.port}")
-        self.reader, self.writer = await asyncio.open_connection(self.ip_addr, self.port)
+        self.stage = "connect"
+        addresses = await loop.getaddrinfo(self.ip_addr, self.port, type=socket.SOCK_STREAM)
+        # try every resolved address like asyncio.open_connection does, all
+        # within the deadline of the command
+        last_error = None
+        for (family, sock_type, proto, _, address) in addresses:
+            sock = socket.socket(family, sock_type, proto)
+            try:
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, "TCP_KEEPIDLE"):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+                await loop.sock_connect(sock, address)
+                break
+            except OSError as err:
+                sock.close()
+                _LOGGER.debug(f"Connecting to ECU {self.ip_addr} at {address} failed: {err}")
+                last_error = err
+            except BaseException:
+                sock.close()
+                raise
+        else:
+            raise last_error or OSError(f"No address found for ECU {self.ip_addr}")
+        self.sock = sock
         _LOGGER.debug(f"Connected to ECU {self.ip_addr} {self.port}")
         self.socket_open = True
 
-
-    async def async_query_ecu(self):
-        await self.async_open_socket()
-        cmd = self.ecu_query
-        self.ecu_raw_data = await self.async_send_read_from_socket(cmd)
-        await self.async_close_socket()
-        self.process_ecu_data()
-        if self.lifetime_energy == 0:
-            await self.async_close_socket()
-            error = f"ECU returned 0 for lifetime energy, raw data={self.ecu_raw_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        # the ECU likes the socket to be closed and re-opened between commands
-        await asyncio.sleep(self.socket_sleep_time) 
-        await self.async_open_socket()
-        cmd = self.inverter_query_prefix + self.ecu_id + self.inverter_query_suffix
-        self.inverter_raw_data = await self.async_send_read_from_socket(cmd)
-        await self.async_close_socket()
-
-        # the ECU likes the socket to be closed and re-opened between commands
-        await asyncio.sleep(self.socket_sleep_time)  
-        await self.async_open_socket()
-        cmd = self.inverter_signal_prefix + self.ecu_id + self.inverter_signal_suffix
-        self.inverter_raw_signal = await self.async_send_read_from_socket(cmd)
-
-        await self.async_close_socket()
-        data = self.process_inverter_data()
-        data["ecu_id"] = self.ecu_id
-        data["ecu_firmware"] = self.firmware
-        data["today_energy"] = self.today_energy
-        data["lifetime_energy"] = self.lifetime_energy
-        data["current_power"] = self.current_power
-        data["qty_of_inverters"] = self.qty_of_inverters
-        data["qty_of_online_inverters"] = self.qty_of_online_inverters
-        return(data)
- 
-    def aps_int(self, codec, start):
+    async def async_exchange(self, cmd):
         try:
-            return int(binascii.b2a_hex(codec[(start):(start+2)]), 16)
-        except ValueError as err:
-            debug_data = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to int location={start} data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
- 
-    def aps_short(self, codec, start):
-        try:
-            return int(binascii.b2a_hex(codec[(start):(start+1)]), 8)
-        except ValueError as err:
-            debug_data = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to short int location={start} data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-    def aps_double(self, codec, start):
+            await self.async_open_socket()
+            return await self.async_send_read_from_socket(cmd)
+        finally:
+            # also runs when wait_for cancels us, so the socket never leaks
+            await self.async_close_socket()
+
+    async def async_send_command(self, cmd):
+        # the ECU likes a fresh connection per command; one deadline covers
+        # connecting, writing and reading the response
         try:
-            return int (binascii.b2a_hex(codec[(start):(start+4)]), 16)
-        except ValueError as err:
-            debug_data = binascii.b2a_hex(codec)
-            error = f"Unable to convert binary to double location={start} data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-    
-    def aps_bool(self, codec, start):
-        return bool(binascii.b2a_hex(codec[(start):(start+2)]))
-    
-    def aps_uid(self, codec, start):
-        return str(binascii.b2a_hex(codec[(start):(start+12)]))[2:14]
-    
-    def aps_str(self, codec, start, amount):
-        return str(codec[start:(start+amount)])[2:(amount+2)]
-    
-    def aps_timestamp(self, codec, start, amount):
-        time_str=str(binascii.b2a_hex(codec[start:(start+amount)]))[2:(amount+2)]
-        return time_str[0:4]+"-"+time_str[4:6]+"-"+time_str[6:8]+" "+time_str[8:10]+":"+time_str[10:12]+":"+time_str[12:14]
-
-    def check_ecu_checksum(self, data, cmd):
-        data_len = len(data) - 1
+            return await asyncio.wait_for(self.async_exchange(cmd), timeout=self.timeout)
+        except asyncio.TimeoutError as err:
+            msg = f"Timeout after {self.timeout}s during {self.stage} cmd={cmd.decode('ascii', 'replace').rstrip()}. Closed socket."
+            raise APSystemsInvalidData(msg)
+
+    async def async_query_ecu(self):
+        cycle = self.protocol.query_cycle()
         try:
-            checksum = int(data[5:9])
-        except ValueError as err:
-            debug_data = binascii.b2a_hex(data)
-            error = f"Error getting checksum int from '{cmd}' data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        if data_len != checksum:
-            debug_data = binascii.b2a_hex(data)
-            error = f"Checksum on '{cmd}' failed checksum={checksum} data_len={data_len} data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        start_str = self.aps_str(data, 0, 3)
-        end_str = self.aps_str(data, len(data) - 4, 3)
-
-        if start_str != 'APS':
-            debug_data = binascii.b2a_hex(data)
-            error = f"Result on '{cmd}' incorrect start signature '{start_str}' != APS data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        if end_str != 'END':
-            debug_data = binascii.b2a_hex(data)
-            error = f"Result on '{cmd}' incorrect end signature '{end_str}' != END data={debug_data}"
-            self.add_error(error)
-            raise APSystemsInvalidData(error)
-
-        return True
+            cmd = next(cycle)
+            while True:
+                frame = await self.async_send_command(cmd)
+                try:
+                    cmd = cycle.send(frame)
+                except StopIteration as stop:
+                    data = stop.value
+                    break
+                # the ECU likes the socket to be closed and re-opened between commands
+                await asyncio.sleep(self.socket_sleep_time)
+        except APSystemsInvalidData as err:
+            self.add_error(str(err))
+            raise
+        finally:
+            self.update_from_protocol()
+
+        self.update_from_data(data)
+        return(data)
+
+    def update_from_protocol(self):
+        self.ecu_raw_data = self.protocol.ecu_raw_data
+        self.inverter_raw_data = self.protocol.inverter_raw_data
+        self.inverter_raw_signal = self.protocol.inverter_raw_signal
+        if self.protocol.ecu:
+            self.update_from_ecu(self.protocol.ecu)
+
+    def update_from_ecu(self, ecu):
+        self.ecu_id = ecu["ecu_id"]
+        self.firmware = ecu["ecu_firmware"]
+        self.timezone = ecu["timezone"]
+        self.lifetime_energy = ecu["lifetime_energy"]
+        self.current_power = ecu["current_power"]
+        self.today_energy = ecu["today_energy"]
+        self.qty_of_inverters = ecu["qty_of_inverters"]
+        self.qty_of_online_inverters = ecu["qty_of_online_inverters"]
+        self.vsl = ecu["vsl"]
+        self.tsl = ecu["tsl"]
+
+    def update_from_data(self, data):
+        self.last_update = data["timestamp"]
+        self.inverters = data["inverters"]
 
     def process_ecu_data(self, data=None):
         if not data:
             data = self.ecu_raw_data
 
-        self.check_ecu_checksum(data, "ECU Query")
-        self.ecu_id = self.aps_str(data, 13, 12)
-        self.lifetime_energy = self.aps_double(data, 27) / 10
-        self.current_power = self.aps_double(data, 31)
-        self.today_energy = self.aps_double(data, 35) / 100
-        if self.aps_str(data,25,2) == "01":
-            self.qty_of_inverters = self.aps_int(data, 46)
-            self.qty_of_online_inverters = self.aps_int(data, 48)
-            self.vsl = int(self.aps_str(data, 52, 3))
-            self.firmware = self.aps_str(data, 55, self.vsl)
-            self.tsl = int(self.aps_str(data, 55 + self.vsl, 3))
-            self.timezone = self.aps_str(data, 58 + self.vsl, self.tsl)
-        elif self.aps_str(data,25,2) == "02":
-            self.qty_of_inverters = self.aps_int(data, 39)
-            self.qty_of_online_inverters = self.aps_int(data, 41)
-            self.vsl = int(self.aps_str(data, 49, 3))
-            self.firmware = self.aps_str(data, 52, self.vsl)
+        try:
+            ecu = self.protocol.process_ecu_data(data)
+        except APSystemsInvalidData as err:
+            self.add_error(str(err))
+            raise
+        self.update_from_ecu(ecu)
+        return ecu
 
     def process_signal_data(self, data=None):
-        signal_data = {}
-        if self.inverter_raw_signal != '' and (self.aps_str(self.inverter_raw_signal,9,4)) == '0030':
+        if not data:
             data = self.inverter_raw_signal
-            _LOGGER.debug(binascii.b2a_hex(data))
-            self.check_ecu_checksum(data, "Signal Query")
-            if not self.qty_of_inverters:
-                return signal_data
-            location = 15
-            for i in range(0, self.qty_of_inverters):
-                uid = self.aps_uid(data, location)
-                location += 6
-                strength = data[location]
-                location += 1
-                strength = int((strength / 255) * 100)
-                signal_data[uid] = strength
-            return signal_data
+
+        try:
+            return self.protocol.process_signal_data(data, self.qty_of_inverters)
+        except APSystemsInvalidData as err:
+            self.add_error(str(err))
+            raise
 
     def process_inverter_data(self, data=None):
         if not data:
             data = self.inverter_raw_data
 
-        self.check_ecu_checksum(data, "Inverter data")
-
-        output = {}
-
-        timestamp = self.aps_timestamp(data, 19, 14)
-        inverter_qty = self.aps_int(data, 17)
-
-        self.last_update = timestamp
-        output["timestamp"] = timestamp
-        output["inverter_qty"] = inverter_qty
-        output["inverters"] = {}
-
-        # this is the start of the loop of inverters
-        inverter_type = ''
-        cnt2 = self.inverter_byte_start
         signal = self.process_signal_data()
-        inverters = {}
-        
-        for i in range(0, inverter_qty):
-            inv={}
-            inverter_uid = self.aps_uid(data, cnt2)
-            inv["uid"] = inverter_uid
-            inv["online"] = bool(self.aps_short(data, cnt2 + 6))
-            inverter_type = self.aps_str(data, cnt2 + 7, 2)
-            inv["signal"] = signal.get(inverter_uid, 0)
-            inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
-            inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
-            # data supplied varies by InverterType!
-            if inverter_type == '01' or inverter_type == '04':
-                (channel_data, cnt2) = self.process_yc600_ds3(data, cnt2)
-                inv.update(channel_data)    
-            elif inverter_type == '02':
-                (channel_data, cnt2) = self.process_yc1000(data, cnt2)
-                inv.update(channel_data)
-            elif inverter_type == '03':
-                (channel_data, cnt2) = self.process_qs1(data, cnt2)
-                inv.update(channel_data)
-            else:
-                error = f"Unsupported inverter type {inverter_type} please create GitHub issue."
-                self.add_error(error)
-                raise APSystemsInvalidData(error)
-            inverters[inverter_uid] = inv
-        self.inverters = inverters
-        output["inverters"] = inverters
+        try:
+            output = self.protocol.process_inverter_data(data, signal)
+        except APSystemsInvalidData as err:
+            self.add_error(str(err))
+            raise
+        self.last_update = output["timestamp"]
+        self.inverters = output["inverters"]
         return (output)
-    
-    def process_yc1000(self, data, cnt2):
-        power = []
-        voltages = []
-        power.append(self.aps_int(data, cnt2 + 13))
-        voltages.append(self.aps_int(data, cnt2 + 15))
-        power.append(self.aps_int(data, cnt2 + 17))
-        voltages.append(self.aps_int(data, cnt2 + 19))
-        power.append(self.aps_int(data, cnt2 + 21))
-        voltages.append(self.aps_int(data, cnt2 + 23))
-        power.append(self.aps_int(data, cnt2 + 25))
-        output = {
-            "model" : "YC1000",
-            "channel_qty" : 4,
-            "power" : power,
-            "voltage" : voltages
-        }
-        return (output, cnt2)
-
-    def process_qs1(self, data, cnt2):
-        power = []
-        voltages = []
-        power.append(self.aps_int(data, cnt2 + 13))
-        voltages.append(self.aps_int(data, cnt2 + 15))
-        power.append(self.aps_int(data, cnt2 + 17))
-        power.append(self.aps_int(data, cnt2 + 19))
-        power.append(self.aps_int(data, cnt2 + 21))
-        output = {
-            "model" : "QS1",
-            "channel_qty" : 4,
-            "power" : power,
-            "voltage" : voltages
-        }
-        return (output, cnt2)
-
-    def process_yc600_ds3(self, data, cnt2):
-        print ("process_yc600_ds3")
-        print ("cnt2:", cnt2)
-        # print ("data:", data)
-        print(f"data(hex): {data.hex()}")
-        power = []
-        voltages = []
-        currents = []
-        power.append(self.aps_int(data, cnt2 + 13))
-        voltages.append(self.aps_int(data, cnt2 + 15))
-        power.append(self.aps_int(data, cnt2 + 17))
-        voltages.append(self.aps_int(data, cnt2 + 19))
-        output = {
-            "model" : "YC600/DS3 [-S-M-D-L]",
-            "MPPT_channel_qty" : 2,
-            "DC_power" : power,
-            "DC_voltage" : voltages,
-            "DC_current" : currents,
-        }
-        return (output, cnt2)
 
     def add_error(self, error):
         timestamp = datetime.datetime.now()
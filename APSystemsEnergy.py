@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# per-inverter and per-panel energy from successive poll snapshots.
+# The ECU only reports energy for the whole site (today_energy and
+# lifetime_energy), the inverters only report instantaneous power per channel.
+
+import datetime
+import json
+import logging
+import os
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class APSystemsEnergyIntegrator:
+    """Integrate per-channel power into Wh counters with the trapezoid rule.
+
+    Each update() costs O(1) per channel and only the previous sample of
+    every inverter is kept, so no raw history needs to be stored. Intervals
+    longer than max_gap seconds, intervals where the inverter was offline
+    at either end and the interval across midnight are not integrated; the
+    sample after them just becomes the new starting point.
+    """
+
+    def __init__(self, max_gap=900):
+        # longest interval (seconds) between two samples we still integrate
+        self.max_gap = max_gap
+
+        # ECU date of the last sample, the today counters reset when it changes
+        self.day = None
+
+        # uid -> {"time", "online", "power", "today_wh", "lifetime_wh"}
+        self.inverters = {}
+
+    def channel_power(self, inv):
+        # field name depends on the model, see APSystemsProtocol.process_*
+        if "DC_power" in inv:
+            return inv["DC_power"]
+        return inv.get("power", [])
+
+    def update(self, data):
+        timestamp = datetime.datetime.strptime(data["timestamp"], "%Y-%m-%d %H:%M:%S")
+        # the ECU timestamp is wall-clock time in the ECU's own timezone; take
+        # it as is, reading it as host local time breaks across host DST changes
+        now = (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
+        day = timestamp.date().isoformat()
+
+        new_day = self.day is not None and day != self.day
+        if new_day:
+            for state in self.inverters.values():
+                state["today_wh"] = [0.0] * len(state["today_wh"])
+        self.day = day
+
+        for uid, inv in data["inverters"].items():
+            online = bool(inv["online"])
+            power = [float(p) if online else 0.0 for p in self.channel_power(inv)]
+
+            state = self.inverters.get(uid)
+            if state is None or len(state["power"]) != len(power):
+                # first sample of this inverter (or its channel count changed)
+                self.inverters[uid] = {
+                    "time" : now,
+                    "online" : online,
+                    "power" : power,
+                    "today_wh" : [0.0] * len(power),
+                    "lifetime_wh" : [0.0] * len(power),
+                }
+                continue
+
+            dt = now - state["time"]
+            if dt == 0:
+                # same ECU data as last poll, nothing new to integrate
+                continue
+
+            if 0 < dt <= self.max_gap and online and state["online"] and not new_day:
+                hours = dt / 3600
+                last_power = state["power"]
+                today_wh = state["today_wh"]
+                lifetime_wh = state["lifetime_wh"]
+                for channel, p in enumerate(power):
+                    wh = (last_power[channel] + p) / 2 * hours
+                    today_wh[channel] += wh
+                    lifetime_wh[channel] += wh
+            elif dt > 0:
+                _LOGGER.debug(f"Not integrating {uid} over {dt}s online={state['online']}/{online} new_day={new_day}")
+            else:
+                _LOGGER.debug(f"ECU timestamp for {uid} went backwards by {-dt}s, restarting integration")
+
+            state["time"] = now
+            state["online"] = online
+            state["power"] = power
+
+    def energy(self):
+        output = {}
+        for uid, state in self.inverters.items():
+            output[uid] = {
+                "today_wh" : sum(state["today_wh"]),
+                "lifetime_wh" : sum(state["lifetime_wh"]),
+                "channel_today_wh" : list(state["today_wh"]),
+                "channel_lifetime_wh" : list(state["lifetime_wh"]),
+            }
+        return output
+
+    def get_state(self):
+        return {
+            "day" : self.day,
+            "inverters" : self.inverters,
+        }
+
+    def set_state(self, state):
+        self.day = state.get("day")
+        self.inverters = state.get("inverters", {})
+
+    def save(self, path):
+        # write then rename so a crash never leaves a truncated state file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.get_state(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_gap=900):
+        integrator = cls(max_gap)
+        try:
+            with open(path) as f:
+                integrator.set_state(json.load(f))
+        except FileNotFoundError:
+            pass
+        return integrator
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# periodic poller for APSystemsECU with an in-process event bus.
+# Every poll publishes a "snapshot" (the async_query_ecu() result), a "delta"
+# (only what changed since the previous snapshot) or an "error" event. Sinks
+# (logger, database, HTTP push, metrics...) subscribe to the bus and consume at
+# their own pace from a bounded queue, so a slow sink no longer delays the
+# next poll or the other sinks.
+
+import asyncio
+import collections
+import logging
+import time
+
+from APSystemsProtocol import APSystemsInvalidData
+
+_LOGGER = logging.getLogger(__name__)
+
+APSystemsEvent = collections.namedtuple("APSystemsEvent", ["kind", "time", "data"])
+
+# what a subscription does when an event arrives and its queue is full
+DROP_OLDEST = "drop_oldest"
+COALESCE_LATEST = "coalesce_latest"
+BLOCK = "block"
+
+
+class APSystemsSubscription:
+    """Bounded event queue of one subscriber.
+
+    Overflow policies:
+    drop_oldest      discard the oldest queued event to make room
+    coalesce_latest  a new event replaces a queued event of the same kind;
+                     deltas are merged into the queued delta instead, so no
+                     changed field is lost. Falls back to drop_oldest when
+                     no event of that kind is queued
+    block            the publisher waits for room; this keeps every event but
+                     lets a slow subscriber hold up the poller
+    """
+
+    def __init__(self, bus, maxsize=16, policy=DROP_OLDEST, kinds=None):
+        if policy not in (DROP_OLDEST, COALESCE_LATEST, BLOCK):
+            raise ValueError(f"Unknown overflow policy {policy}")
+        self.bus = bus
+        self.maxsize = maxsize
+        self.policy = policy
+        # None means all kinds
+        self.kinds = set(kinds) if kinds else None
+
+        self.queue = collections.deque()
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+        # how many events this subscriber lost to its overflow policy
+        self.dropped = 0
+        self.closed = False
+
+    def wants(self, event):
+        return self.kinds is None or event.kind in self.kinds
+
+    def merge_delta(self, old, new):
+        data = dict(old)
+        data.update((key, value) for key, value in new.items() if key != "inverters")
+        if "inverters" in new:
+            inverters = dict(old.get("inverters", {}))
+            inverters.update(new["inverters"])
+            data["inverters"] = inverters
+        return data
+
+    def coalesce(self, event):
+        # newest queued event of the same kind absorbs this one
+        for i in range(len(self.queue) - 1, -1, -1):
+            queued = self.queue[i]
+            if queued.kind == event.kind:
+                if event.kind == "delta":
+                    event = event._replace(data=self.merge_delta(queued.data, event.data))
+                self.queue[i] = event
+                self.dropped += 1
+                return True
+        return False
+
+    async def put(self, event):
+        if self.policy == COALESCE_LATEST and len(self.queue) >= self.maxsize:
+            if self.coalesce(event):
+                self.not_empty.set()
+                return
+
+        while len(self.queue) >= self.maxsize and not self.closed:
+            if self.policy == BLOCK:
+                self.not_full.clear()
+                await self.not_full.wait()
+            else:
+                self.queue.popleft()
+                self.dropped += 1
+
+        if self.closed:
+            return
+        self.queue.append(event)
+        self.not_empty.set()
+
+    async def get(self):
+        while not self.queue:
+            if self.closed:
+                raise StopAsyncIteration
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        event = self.queue.popleft()
+        self.not_full.set()
+        return event
+
+    def close(self):
+        self.closed = True
+        self.bus.unsubscribe(self)
+        # wake up anybody waiting on us
+        self.not_empty.set()
+        self.not_full.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class APSystemsEventBus:
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def subscribe(self, maxsize=16, policy=DROP_OLDEST, kinds=None):
+        subscription = APSystemsSubscription(self, maxsize, policy, kinds)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    async def publish(self, kind, data):
+        event = APSystemsEvent(kind, time.time(), data)
+        for subscription in list(self.subscriptions):
+            if subscription.wants(event):
+                await subscription.put(event)
+
+
+class APSystemsPoller:
+
+    def __init__(self, ecu, interval=60.0, bus=None):
+        # an APSystemsECU (or anything with async_query_ecu)
+        self.ecu = ecu
+        # seconds between the start of two polls
+        self.interval = interval
+        self.bus = bus if bus is not None else APSystemsEventBus()
+
+        self.last_data = None
+        self.task = None
+
+    def delta(self, old, new):
+        if old is None:
+            return new
+
+        output = {}
+        for key, value in new.items():
+            if key not in ("inverters", "new_data") and old.get(key) != value:
+                output[key] = value
+
+        # unchanged inverter data is the very same (cached) object
+        if new["inverters"] is not old["inverters"]:
+            old_inverters = old["inverters"]
+            inverters = {}
+            for uid, inv in new["inverters"].items():
+                if old_inverters.get(uid) != inv:
+                    inverters[uid] = inv
+            if inverters:
+                output["inverters"] = inverters
+        return output
+
+    async def async_poll(self):
+        try:
+            data = await self.ecu.async_query_ecu()
+        except (APSystemsInvalidData, OSError, asyncio.TimeoutError) as err:
+            _LOGGER.warning(f"Polling ECU {self.ecu.ip_addr} failed: {err}")
+            await self.bus.publish("error", err)
+            return None
+        except Exception as err:
+            # anything else is a bug, but it must not end the poll loop
+            _LOGGER.exception(f"Polling ECU {self.ecu.ip_addr} failed unexpectedly: {err}")
+            await self.bus.publish("error", err)
+            return None
+
+        delta = self.delta(self.last_data, data)
+        self.last_data = data
+        await self.bus.publish("snapshot", data)
+        if delta:
+            await self.bus.publish("delta", delta)
+        return data
+
+    async def async_run(self):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time()
+        while True:
+            await self.async_poll()
+            next_poll += self.interval
+            now = loop.time()
+            if next_poll < now:
+                # the poll took longer than the interval, skip the missed slots
+                # and wait for the next one instead of polling back to back
+                next_poll += ((now - next_poll) // self.interval + 1) * self.interval
+            await asyncio.sleep(next_poll - now)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.async_run())
+        return self.task
+
+    async def async_stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for subscription in list(self.bus.subscriptions):
+            subscription.close()
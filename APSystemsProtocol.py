@@ -0,0 +1,521 @@
+#!/usr/bin/env python3
+
+# sans-IO core of the APSystems ECU protocol shared by the asyncio client
+# (APSystemsECU.py) and the synchronous client (ECUquery.py).
+# Nothing in here touches a socket: commands go out as bytes, bytes come in
+# and are turned into frames, parsed ECU/inverter data and poll snapshots.
+
+import binascii
+import datetime
+import logging
+from collections import OrderedDict
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class APSystemsInvalidData(Exception):
+    pass
+
+class APSystemsInvalidInverter(Exception):
+    pass
+
+
+class FrozenDict(dict):
+    # a dict that refuses changes, still serializable with json.dumps
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached ECU data is read-only, copy it with dict() first")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        # rebuild through dict.__init__, copy and pickle would otherwise
+        # fill an empty instance with __setitem__
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+
+def freeze(obj):
+    # dicts become FrozenDicts and lists (per channel power, voltage...) tuples
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+class APSystemsParseCache:
+    """LRU of decoded frames keyed on the command and a hash of its raw response.
+
+    The ECU only refreshes inverter data every ~5 minutes, so most polls
+    return byte-identical frames; those are answered with the previously
+    decoded, frozen result instead of being validated and decoded again.
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, cmd, frames, parse):
+        """Return (result, cached) for the raw frames of cmd, calling parse() on a miss."""
+        key = (cmd, hash(frames))
+        entry = self.entries.get(key)
+        # compare the frames too, a hash collision must not return stale data
+        if entry is not None and entry[0] == frames:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (entry[1], True)
+
+        self.misses += 1
+        result = freeze(parse())
+        self.entries[key] = (frames, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return (result, False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class HexBytes:
+    # formats to hex only when a log record actually gets emitted
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.hex()
+
+
+class APSystemsTrace:
+    """Debug tracing of raw ECU frames, disabled by default.
+
+    Call sites check trace.enabled first, so a disabled trace costs one
+    attribute lookup per frame. When enabled, frames are logged at DEBUG
+    level (hex formatted lazily) and optionally appended to capture_path.
+    commands limits tracing to "ecu", "inverter" and/or "signal" frames,
+    inverters limits it to the records of those inverter uids (the full
+    inverter frame is then not logged) and sample_every traces only every
+    Nth frame of each command.
+
+    query_cycle() traces every received frame, also the ones answered from
+    the parse cache. Inverter records are only logged when the frame is
+    actually decoded; a byte-identical frame repeats the records already
+    logged for it.
+    """
+
+    def __init__(self, enabled=False, commands=None, inverters=None, sample_every=1, capture_path=None, logger=None):
+        self.enabled = enabled
+        self.commands = set(commands) if commands else None
+        self.inverters = set(inverters) if inverters else None
+        self.sample_every = max(1, sample_every)
+        self.capture_path = capture_path
+        self.logger = logger if logger is not None else _LOGGER
+
+        # frames seen per command, drives sample_every
+        self.counts = {}
+
+    def frame(self, cmd, data):
+        """Trace one raw frame, returns whether this frame was sampled."""
+        if self.commands is not None and cmd not in self.commands:
+            return False
+        count = self.counts[cmd] = self.counts.get(cmd, 0) + 1
+        if (count - 1) % self.sample_every:
+            return False
+
+        if cmd == "inverter" and self.inverters is not None:
+            return True
+        self.logger.debug("%s frame len=%d data(hex)=%s", cmd, len(data), HexBytes(data))
+        if self.capture_path:
+            with open(self.capture_path, "a") as f:
+                f.write(f"{datetime.datetime.now().isoformat()} {cmd} {data.hex()}\n")
+        return True
+
+    def inverter(self, uid, inverter_type, location, record):
+        if self.inverters is not None and uid not in self.inverters:
+            return
+        self.logger.debug("inverter %s type=%s location=%d data(hex)=%s", uid, inverter_type, location, HexBytes(record))
+        if self.capture_path:
+            with open(self.capture_path, "a") as f:
+                f.write(f"{datetime.datetime.now().isoformat()} inverter:{uid} {record.hex()}\n")
+
+
+class APSystemsProtocol:
+
+    def __init__(self, trace=None):
+        # what do we expect socket data to end in
+        self.recv_suffix = b'END\n'
+
+        self.cmd_suffix = "END\n"
+        self.ecu_query = "APS1100160001" + self.cmd_suffix
+        self.inverter_query_prefix = "APS1100280002"
+        self.inverter_query_suffix = self.cmd_suffix
+
+        self.inverter_signal_prefix = "APS1100280030"
+        self.inverter_signal_suffix = self.cmd_suffix
+
+        self.inverter_byte_start = 26
+
+        # raw frame tracing for debugging, see APSystemsTrace
+        self.trace = trace if trace is not None else APSystemsTrace()
+
+        # decoded results of recently seen frames, see APSystemsParseCache
+        self.parse_cache = APSystemsParseCache()
+
+        # bytes received but not yet returned as a complete frame
+        self.read_buffer = bytearray()
+
+        # parsed ECU header and raw frames of the last poll
+        self.ecu = None
+        self.ecu_raw_data = None
+        self.inverter_raw_data = None
+        self.inverter_raw_signal = None
+
+    # --- commands -> bytes ---
+
+    def ecu_command(self):
+        return self.ecu_query.encode('utf-8')
+
+    def inverter_command(self, ecu_id):
+        cmd = self.inverter_query_prefix + ecu_id + self.inverter_query_suffix
+        return cmd.encode('utf-8')
+
+    def signal_command(self, ecu_id):
+        cmd = self.inverter_signal_prefix + ecu_id + self.inverter_signal_suffix
+        return cmd.encode('utf-8')
+
+    # --- bytes -> frames ---
+
+    def reset(self):
+        # the ECU wants a fresh connection per command, so anything left over
+        # from the previous connection is garbage
+        self.read_buffer.clear()
+
+    def receive_data(self, data):
+        self.read_buffer += data
+
+    def next_frame(self):
+        """Return the next complete frame from the receive buffer or None.
+
+        Frames are delimited by the length in bytes 5-8 of the header
+        (which excludes the trailing newline); if that is unreadable the
+        frame runs up to the first END suffix and is left for
+        check_ecu_checksum to reject.
+        """
+        buf = self.read_buffer
+        if len(buf) < 9:
+            return None
+        try:
+            frame_len = int(buf[5:9]) + 1
+        except ValueError:
+            end = buf.find(self.recv_suffix)
+            if end == -1:
+                return None
+            frame_len = end + len(self.recv_suffix)
+        if len(buf) < frame_len:
+            return None
+        frame = bytes(buf[:frame_len])
+        del buf[:frame_len]
+
+        if frame[-4:] != self.recv_suffix:
+            error = f"End suffix ({self.recv_suffix}) missing from ECU response end_data={frame[-4:]} data={frame}"
+            raise APSystemsInvalidData(error)
+        return frame
+
+    # --- frames -> snapshot ---
+
+    def query_cycle(self):
+        """Generator driving one full poll of the ECU.
+
+        Yields the command bytes to send, expects the matching response
+        frame to be passed back with send() and finally returns the poll
+        snapshot as the StopIteration value. Frames identical to a recent
+        poll are not decoded again; the snapshot then shares the frozen
+        inverter data of that poll. new_data is False only when both the
+        ECU and the inverter frames are unchanged.
+        """
+        cache = self.parse_cache
+
+        # frames are traced here rather than in process_*, which only run
+        # when the parse cache misses
+        trace = self.trace
+
+        self.ecu_raw_data = yield self.ecu_command()
+        if trace.enabled:
+            trace.frame("ecu", self.ecu_raw_data)
+        ecu, ecu_cached = cache.lookup("ecu", (self.ecu_raw_data,),
+                              lambda: self.process_ecu_data(self.ecu_raw_data, traced=False))
+        self.ecu = ecu
+        if ecu["lifetime_energy"] == 0:
+            error = f"ECU returned 0 for lifetime energy, raw data={self.ecu_raw_data}"
+            raise APSystemsInvalidData(error)
+
+        self.inverter_raw_data = yield self.inverter_command(ecu["ecu_id"])
+        self.inverter_raw_signal = yield self.signal_command(ecu["ecu_id"])
+
+        traced = trace.enabled and trace.frame("inverter", self.inverter_raw_data)
+        if trace.enabled and self.inverter_raw_signal:
+            trace.frame("signal", self.inverter_raw_signal)
+
+        qty = ecu["qty_of_inverters"]
+        signal, _ = cache.lookup("signal", (self.inverter_raw_signal, qty),
+                                 lambda: self.process_signal_data(self.inverter_raw_signal, qty, traced=False))
+        data, cached = cache.lookup("inverter", (self.inverter_raw_data, self.inverter_raw_signal, qty),
+                                    lambda: self.process_inverter_data(self.inverter_raw_data, signal, traced=traced))
+        snapshot = self.build_snapshot(ecu, data)
+        # new unless both the ECU header and the inverter data are unchanged
+        snapshot["new_data"] = not (ecu_cached and cached)
+        return snapshot
+
+    def build_snapshot(self, ecu, data):
+        # data may be a cached FrozenDict, the snapshot itself is a fresh dict
+        snapshot = dict(data)
+        snapshot["ecu_id"] = ecu["ecu_id"]
+        snapshot["ecu_firmware"] = ecu["ecu_firmware"]
+        snapshot["today_energy"] = ecu["today_energy"]
+        snapshot["lifetime_energy"] = ecu["lifetime_energy"]
+        snapshot["current_power"] = ecu["current_power"]
+        snapshot["qty_of_inverters"] = ecu["qty_of_inverters"]
+        snapshot["qty_of_online_inverters"] = ecu["qty_of_online_inverters"]
+        return snapshot
+
+    def aps_int(self, codec, start):
+        try:
+            return int(binascii.b2a_hex(codec[(start):(start+2)]), 16)
+        except ValueError as err:
+            debug_data = binascii.b2a_hex(codec)
+            error = f"Unable to convert binary to int location={start} data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+    def aps_short(self, codec, start):
+        try:
+            return int(binascii.b2a_hex(codec[(start):(start+1)]), 8)
+        except ValueError as err:
+            debug_data = binascii.b2a_hex(codec)
+            error = f"Unable to convert binary to short int location={start} data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+    def aps_double(self, codec, start):
+        try:
+            return int (binascii.b2a_hex(codec[(start):(start+4)]), 16)
+        except ValueError as err:
+            debug_data = binascii.b2a_hex(codec)
+            error = f"Unable to convert binary to double location={start} data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+    def aps_len(self, codec, start):
+        # 3 ascii digits giving the length of the string that follows
+        try:
+            return int(self.aps_str(codec, start, 3))
+        except ValueError as err:
+            debug_data = binascii.b2a_hex(codec)
+            error = f"Unable to convert ascii length location={start} data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+    def aps_bool(self, codec, start):
+        return bool(binascii.b2a_hex(codec[(start):(start+2)]))
+
+    def aps_uid(self, codec, start):
+        return str(binascii.b2a_hex(codec[(start):(start+12)]))[2:14]
+
+    def aps_str(self, codec, start, amount):
+        return str(codec[start:(start+amount)])[2:(amount+2)]
+
+    def aps_timestamp(self, codec, start, amount):
+        time_str=str(binascii.b2a_hex(codec[start:(start+amount)]))[2:(amount+2)]
+        return time_str[0:4]+"-"+time_str[4:6]+"-"+time_str[6:8]+" "+time_str[8:10]+":"+time_str[10:12]+":"+time_str[12:14]
+
+    def check_ecu_checksum(self, data, cmd):
+        data_len = len(data) - 1
+        try:
+            checksum = int(data[5:9])
+        except ValueError as err:
+            debug_data = binascii.b2a_hex(data)
+            error = f"Error getting checksum int from '{cmd}' data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+        if data_len != checksum:
+            debug_data = binascii.b2a_hex(data)
+            error = f"Checksum on '{cmd}' failed checksum={checksum} data_len={data_len} data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+        start_str = self.aps_str(data, 0, 3)
+        end_str = self.aps_str(data, len(data) - 4, 3)
+
+        if start_str != 'APS':
+            debug_data = binascii.b2a_hex(data)
+            error = f"Result on '{cmd}' incorrect start signature '{start_str}' != APS data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+        if end_str != 'END':
+            debug_data = binascii.b2a_hex(data)
+            error = f"Result on '{cmd}' incorrect end signature '{end_str}' != END data={debug_data}"
+            raise APSystemsInvalidData(error)
+
+        return True
+
+    # traced=None traces the frame here, query_cycle() passes whether it
+    # already traced it
+
+    def process_ecu_data(self, data, traced=None):
+        if traced is None and self.trace.enabled:
+            self.trace.frame("ecu", data)
+        self.check_ecu_checksum(data, "ECU Query")
+        output = {
+            "ecu_id" : self.aps_str(data, 13, 12),
+            "ecu_firmware" : None,
+            "timezone" : None,
+            "lifetime_energy" : self.aps_double(data, 27) / 10,
+            "current_power" : self.aps_double(data, 31),
+            "today_energy" : self.aps_double(data, 35) / 100,
+            "qty_of_inverters" : 0,
+            "qty_of_online_inverters" : 0,
+            "vsl" : 0,
+            "tsl" : 0,
+        }
+        if self.aps_str(data,25,2) == "01":
+            output["qty_of_inverters"] = self.aps_int(data, 46)
+            output["qty_of_online_inverters"] = self.aps_int(data, 48)
+            vsl = output["vsl"] = self.aps_len(data, 52)
+            output["ecu_firmware"] = self.aps_str(data, 55, vsl)
+            tsl = output["tsl"] = self.aps_len(data, 55 + vsl)
+            output["timezone"] = self.aps_str(data, 58 + vsl, tsl)
+        elif self.aps_str(data,25,2) == "02":
+            output["qty_of_inverters"] = self.aps_int(data, 39)
+            output["qty_of_online_inverters"] = self.aps_int(data, 41)
+            vsl = output["vsl"] = self.aps_len(data, 49)
+            output["ecu_firmware"] = self.aps_str(data, 52, vsl)
+        return output
+
+    def process_signal_data(self, data, qty_of_inverters, traced=None):
+        signal_data = {}
+        # trace before the checks, a malformed frame is the interesting one
+        if traced is None and self.trace.enabled and data:
+            self.trace.frame("signal", data)
+        if not data or self.aps_str(data,9,4) != '0030':
+            return signal_data
+        self.check_ecu_checksum(data, "Signal Query")
+        location = 15
+        # every entry is a 6 byte uid and 1 byte strength, followed by END\n
+        if location + qty_of_inverters * 7 > len(data) - 4:
+            debug_data = binascii.b2a_hex(data)
+            error = f"Signal data too short for {qty_of_inverters} inverters data_len={len(data)} data={debug_data}"
+            raise APSystemsInvalidData(error)
+        for i in range(0, qty_of_inverters):
+            uid = self.aps_uid(data, location)
+            location += 6
+            strength = data[location]
+            location += 1
+            strength = int((strength / 255) * 100)
+            signal_data[uid] = strength
+        return signal_data
+
+    def process_inverter_data(self, data, signal=None, traced=None):
+        if signal is None:
+            signal = {}
+
+        if traced is None:
+            traced = self.trace.enabled and self.trace.frame("inverter", data)
+        self.check_ecu_checksum(data, "Inverter data")
+
+        output = {}
+
+        timestamp = self.aps_timestamp(data, 19, 14)
+        inverter_qty = self.aps_int(data, 17)
+
+        output["timestamp"] = timestamp
+        output["inverter_qty"] = inverter_qty
+        output["inverters"] = {}
+
+        # this is the start of the loop of inverters
+        inverter_type = ''
+        cnt2 = self.inverter_byte_start
+        inverters = {}
+
+        for i in range(0, inverter_qty):
+            start = cnt2
+            inv={}
+            inverter_uid = self.aps_uid(data, cnt2)
+            inv["uid"] = inverter_uid
+            inv["online"] = bool(self.aps_short(data, cnt2 + 6))
+            inverter_type = self.aps_str(data, cnt2 + 7, 2)
+            inv["signal"] = signal.get(inverter_uid, 0)
+            inv["frequency"] = self.aps_int(data, cnt2 + 9) / 10
+            inv["temperature"] = self.aps_int(data, cnt2 + 11) - 100
+            # data supplied varies by InverterType!
+            if inverter_type == '01' or inverter_type == '04':
+                (channel_data, cnt2) = self.process_yc600_ds3(data, cnt2)
+                inv.update(channel_data)
+            elif inverter_type == '02':
+                (channel_data, cnt2) = self.process_yc1000(data, cnt2)
+                inv.update(channel_data)
+            elif inverter_type == '03':
+                (channel_data, cnt2) = self.process_qs1(data, cnt2)
+                inv.update(channel_data)
+            else:
+                error = f"Unsupported inverter type {inverter_type} please create GitHub issue."
+                raise APSystemsInvalidData(error)
+            if traced:
+                self.trace.inverter(inverter_uid, inverter_type, start, data[start:cnt2])
+            inverters[inverter_uid] = inv
+        output["inverters"] = inverters
+        return (output)
+
+    # the process_* channel decoders return the offset of the next inverter
+
+    def process_yc1000(self, data, cnt2):
+        power = []
+        voltages = []
+        power.append(self.aps_int(data, cnt2 + 13))
+        voltages.append(self.aps_int(data, cnt2 + 15))
+        power.append(self.aps_int(data, cnt2 + 17))
+        voltages.append(self.aps_int(data, cnt2 + 19))
+        power.append(self.aps_int(data, cnt2 + 21))
+        voltages.append(self.aps_int(data, cnt2 + 23))
+        power.append(self.aps_int(data, cnt2 + 25))
+        output = {
+            "model" : "YC1000",
+            "channel_qty" : 4,
+            "power" : power,
+            "voltage" : voltages
+        }
+        return (output, cnt2 + 27)
+
+    def process_qs1(self, data, cnt2):
+        power = []
+        voltages = []
+        power.append(self.aps_int(data, cnt2 + 13))
+        voltages.append(self.aps_int(data, cnt2 + 15))
+        power.append(self.aps_int(data, cnt2 + 17))
+        power.append(self.aps_int(data, cnt2 + 19))
+        power.append(self.aps_int(data, cnt2 + 21))
+        output = {
+            "model" : "QS1",
+            "channel_qty" : 4,
+            "power" : power,
+            "voltage" : voltages
+        }
+        return (output, cnt2 + 23)
+
+    def process_yc600_ds3(self, data, cnt2):
+        power = []
+        voltages = []
+        currents = []
+        power.append(self.aps_int(data, cnt2 + 13))
+        voltages.append(self.aps_int(data, cnt2 + 15))
+        power.append(self.aps_int(data, cnt2 + 17))
+        voltages.append(self.aps_int(data, cnt2 + 19))
+        output = {
+            "model" : "YC600/DS3 [-S-M-D-L]",
+            "MPPT_channel_qty" : 2,
+            "DC_power" : power,
+            "DC_voltage" : voltages,
+            "DC_current" : currents,
+        }
+        return (output, cnt2 + 21)
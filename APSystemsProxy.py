@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+# local TCP proxy in front of one ECU.
+# The ECU serves one client at a time on port 8899 and wants the socket closed
+# and re-opened between commands, so Home Assistant, Domoticz, exporters etc.
+# polling the same ECU collide and time out. The proxy speaks the same
+# APS11...END protocol to any number of clients, keeps a single serialized
+# upstream session to the ECU and answers repeated commands from a short-lived
+# cache. Clients only need to point at the proxy instead of the ECU.
+
+import argparse
+import asyncio
+import logging
+import time
+
+from APSystemsECU import APSystemsECU
+from APSystemsProtocol import APSystemsInvalidData
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class APSystemsProxy:
+
+    def __init__(self, ecu_ip, ecu_port=8899, listen_host="0.0.0.0", listen_port=8899, cache_ttl=30.0, client_timeout=30.0):
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+
+        # the upstream ECU session, only ever used while holding upstream_lock
+        self.upstream = APSystemsECU(ecu_ip, ecu_port)
+        self.upstream_lock = asyncio.Lock()
+        self.last_upstream_close = 0.0
+
+        # how long (seconds) an ECU response is served from cache
+        self.cache_ttl = cache_ttl
+
+        # command bytes -> (monotonic time received, response frame)
+        self.cache = {}
+
+        # command bytes -> future of the upstream request in flight
+        self.pending = {}
+
+        # the queries the proxy forwards: the ECU query and the inverter data
+        # and signal queries, which are followed by the 12 digit ECU id
+        protocol = self.upstream.protocol
+        self.ecu_query = protocol.ecu_query.rstrip().encode('utf-8')
+        self.ecu_id_queries = (protocol.inverter_query_prefix.encode('utf-8'),
+                               protocol.inverter_signal_prefix.encode('utf-8'))
+
+        # longest command we accept from a client before dropping it
+        self.max_cmd_size = 64
+
+        # how long (seconds) a client may take to send its next command,
+        # idle or stuck clients must not hold a task and descriptor forever
+        self.client_timeout = client_timeout
+
+        self.server = None
+
+    def cached_response(self, cmd):
+        entry = self.cache.get(cmd)
+        if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+            return entry[1]
+        return None
+
+    async def async_query_upstream(self, cmd):
+        response = self.cached_response(cmd)
+        if response is not None:
+            return response
+
+        # clients asking while this command is already being sent upstream
+        # share its result, including a failure, instead of queueing up and
+        # each retrying a dead ECU in turn
+        pending = self.pending.get(cmd)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        pending = self.pending[cmd] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self.async_send_upstream(cmd)
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        except Exception as err:
+            pending.set_exception(err)
+            # mark it retrieved, nobody else may be waiting on it
+            pending.exception()
+            raise
+        else:
+            pending.set_result(response)
+            return response
+        finally:
+            del self.pending[cmd]
+
+    async def async_send_upstream(self, cmd):
+        async with self.upstream_lock:
+            # the ECU likes the socket to be closed and re-opened between commands
+            wait = self.upstream.socket_sleep_time - (time.monotonic() - self.last_upstream_close)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            try:
+                response = await self.upstream.async_send_command(cmd)
+            finally:
+                self.last_upstream_close = time.monotonic()
+
+            now = time.monotonic()
+            # drop expired entries
+            self.cache = {key: entry for key, entry in self.cache.items() if now - entry[0] < self.cache_ttl}
+            self.cache[cmd] = (now, response)
+            return response
+
+    async def async_read_command(self, reader):
+        cmd = await reader.readuntil(b'END')
+        # the trailing newline of the previous command (if the client sent
+        # one) is still in front of this one
+        cmd = cmd.lstrip(b'\r\n')
+        # only the read-only queries are forwarded and cached, anything else
+        # (unknown or state changing commands) is refused
+        if cmd != self.ecu_query and not any(
+                cmd.startswith(prefix) and len(cmd) == len(prefix) + 12 + 3 for prefix in self.ecu_id_queries):
+            raise APSystemsInvalidData(f"Unsupported command from client {cmd}")
+        return cmd + b'\n'
+
+    async def async_handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        _LOGGER.debug(f"Client connected {peer}")
+        try:
+            while True:
+                try:
+                    cmd = await asyncio.wait_for(self.async_read_command(reader), timeout=self.client_timeout)
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.TimeoutError:
+                    _LOGGER.debug(f"No command from {peer} within {self.client_timeout}s, dropping client")
+                    break
+                except asyncio.LimitOverrunError:
+                    _LOGGER.warning(f"Command from {peer} too long, dropping client")
+                    break
+                response = await self.async_query_upstream(cmd)
+                writer.write(response)
+                await writer.drain()
+        except (APSystemsInvalidData, OSError, asyncio.TimeoutError) as err:
+            _LOGGER.warning(f"Dropping client {peer}: {err}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            _LOGGER.debug(f"Client disconnected {peer}")
+
+    async def async_start(self):
+        self.server = await asyncio.start_server(
+            self.async_handle_client, self.listen_host, self.listen_port, limit=self.max_cmd_size)
+        _LOGGER.info(f"Proxying {self.listen_host}:{self.listen_port} to ECU {self.upstream.ip_addr} {self.upstream.port}")
+
+    async def async_serve_forever(self):
+        if self.server is None:
+            await self.async_start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def async_close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caching proxy in front of an APSystems ECU")
+    parser.add_argument("ecu_ip", help="IP address of the ECU")
+    parser.add_argument("--ecu-port", type=int, default=8899)
+    parser.add_argument("--listen-host", default="0.0.0.0")
+    parser.add_argument("--listen-port", type=int, default=8899)
+    parser.add_argument("--cache-ttl", type=float, default=30.0, help="seconds to serve a response from cache")
+    parser.add_argument("--client-timeout", type=float, default=30.0, help="seconds a client may take to send a command")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    proxy = APSystemsProxy(args.ecu_ip, args.ecu_port, args.listen_host, args.listen_port, args.cache_ttl, args.client_timeout)
+    asyncio.run(proxy.async_serve_forever())
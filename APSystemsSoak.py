@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# scale/soak test harness for APSystemsECU.
+# Starts many synthetic ECUs on loopback ports in a child process (mixed
+# YC600/DS3/YC1000/QS1 inverters, configurable latency and failures) and
+# polls all of them concurrently from this process with APSystemsECU clients.
+# Every report interval it prints p50/p99 poll latency, CPU time per poll,
+# RSS growth, open file descriptors and the size of the clients' error lists,
+# so leaks show up as numbers that keep climbing during a long run.
+#
+# example: 2000 ECUs with 40 inverters each, one poll per minute for 4 hours
+#   python APSystemsSoak.py --ecus 2000 --inverters 40 --interval 60 --duration 14400
+
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import random
+import resource
+import time
+
+from APSystemsECU import APSystemsECU
+from APSystemsProtocol import APSystemsInvalidData
+
+# inverter type byte -> bytes of channel data after the common 13 byte header
+INVERTER_TYPES = {
+    b'01' : 8,   # YC600
+    b'02' : 14,  # YC1000
+    b'03' : 10,  # QS1
+    b'04' : 8,   # DS3
+}
+
+
+def build_frame(cmd_code, body):
+    # 'APS11' + length + command + body + 'END\n', length excludes the newline
+    frame_len = 5 + 4 + 4 + len(body) + 4
+    return b'APS11' + b'%04d' % (frame_len - 1) + cmd_code + body + b'END\n'
+
+
+def build_ecu_frame(ecu_id, inverter_qty, today_energy):
+    body = bytearray()
+    body += ecu_id.encode()
+    body += b'01'
+    body += (19955 + today_energy // 10).to_bytes(4, 'big')   # lifetime energy, 0.1 kWh
+    body += (random.randint(0, 5000)).to_bytes(4, 'big')       # current power, W
+    body += today_energy.to_bytes(4, 'big')                    # today energy, 0.01 kWh
+    body += b'\xd0' * 7
+    body += inverter_qty.to_bytes(2, 'big')
+    body += inverter_qty.to_bytes(2, 'big')
+    body += b'10'
+    firmware = b'ECU_R_1.2.22'
+    timezone = b'Etc/GMT-8'
+    body += b'%03d' % len(firmware) + firmware
+    body += b'%03d' % len(timezone) + timezone
+    body += b'\x00' * 6
+    return build_frame(b'0001', bytes(body))
+
+
+def build_inverter_frames(uids, types):
+    timestamp = bytes.fromhex(time.strftime('%Y%m%d%H%M%S'))
+    body = bytearray(b'0001')
+    body += len(uids).to_bytes(2, 'big')
+    body += timestamp
+    signal = bytearray(b'00')
+    for uid, inverter_type in zip(uids, types):
+        body += uid
+        body += b'\x01'
+        body += inverter_type
+        body += (499 + random.randint(-2, 2)).to_bytes(2, 'big')   # frequency, 0.1 Hz
+        body += (100 + random.randint(10, 60)).to_bytes(2, 'big')  # temperature + 100
+        for i in range(INVERTER_TYPES[inverter_type] // 2):
+            body += random.randint(0, 400).to_bytes(2, 'big')
+        signal += uid + bytes([random.randint(50, 255)])
+    return (build_frame(b'0002', bytes(body)), build_frame(b'0030', bytes(signal)))
+
+
+class SyntheticECU:
+
+    def __init__(self, index, args):
+        self.args = args
+        self.ecu_id = '2160%08d' % index
+        self.uids = [bytes.fromhex('40%04d%06d' % (index % 10000, i)) for i in range(args.inverters)]
+        self.types = [random.choice(list(INVERTER_TYPES)) for i in range(args.inverters)]
+        self.refresh()
+
+    def refresh(self):
+        # a real ECU only refreshes its inverter data every ~5 minutes
+        self.ecu_frame = build_ecu_frame(self.ecu_id, len(self.uids), random.randint(1, 5000))
+        (self.inverter_frame, self.signal_frame) = build_inverter_frames(self.uids, self.types)
+        self.refreshed = time.monotonic()
+
+    async def handle_client(self, reader, writer):
+        try:
+            cmd = await reader.readuntil(b'END')
+            if time.monotonic() - self.refreshed > self.args.refresh:
+                self.refresh()
+            await asyncio.sleep(random.uniform(self.args.latency, 2 * self.args.latency))
+
+            if random.random() < self.args.failure_rate:
+                failure = random.choice(('close', 'silence', 'garbage'))
+                if failure == 'silence':
+                    await asyncio.sleep(self.args.silence)
+                elif failure == 'garbage':
+                    writer.write(os.urandom(32) + b'END\n')
+                    await writer.drain()
+                return
+
+            if cmd.startswith(b'APS1100160001'):
+                writer.write(self.ecu_frame)
+            elif cmd.startswith(b'APS1100280002'):
+                writer.write(self.inverter_frame)
+            elif cmd.startswith(b'APS1100280030'):
+                writer.write(self.signal_frame)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            pass
+        finally:
+            writer.close()
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_servers(args, ready):
+    raise_fd_limit()
+
+    async def serve():
+        servers = []
+        for i in range(args.ecus):
+            ecu = SyntheticECU(i, args)
+            servers.append(await asyncio.start_server(ecu.handle_client, '127.0.0.1', args.base_port + i))
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # ru_maxrss is the peak, not the current RSS, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class SoakStats:
+
+    def __init__(self):
+        self.polls = 0
+        self.failures = collections.Counter()
+        # latencies of all polls and of the failed ones since the last
+        # report, cleared by report(); timeouts are the slowest polls and
+        # must show up in the percentiles
+        self.latencies = []
+        self.failed_latencies = []
+        self.last_cpu = time.process_time()
+        self.last_polls = 0
+        self.start_rss = rss_bytes()
+        self.start_fds = open_fds()
+        self.start = time.monotonic()
+
+    def report(self, clients):
+        cpu = time.process_time()
+        polls = self.polls - self.last_polls
+        cpu_per_poll = (cpu - self.last_cpu) / polls * 1000 if polls else 0.0
+        rss = rss_bytes()
+        errors = sum(len(client.errors) for client in clients)
+        print(f"[{time.monotonic() - self.start:8.0f}s] polls={self.polls} (+{polls}) "
+              f"failures={sum(self.failures.values())} "
+              f"p50={percentile(self.latencies, 50):.3f}s p99={percentile(self.latencies, 99):.3f}s "
+              f"failed p50={percentile(self.failed_latencies, 50):.3f}s p99={percentile(self.failed_latencies, 99):.3f}s "
+              f"cpu/poll={cpu_per_poll:.2f}ms "
+              f"rss={rss / 2**20:.1f}MiB (+{(rss - self.start_rss) / 2**20:.1f}) "
+              f"fds={open_fds()} (start {self.start_fds}) "
+              f"errors_retained={errors} tasks={len(asyncio.all_tasks())}", flush=True)
+        self.latencies = []
+        self.failed_latencies = []
+        self.last_cpu = cpu
+        self.last_polls = self.polls
+
+    def summary(self):
+        for failure, count in self.failures.most_common():
+            print(f"  {count:8d} x {failure}")
+
+
+async def poll_forever(client, args, stats):
+    loop = asyncio.get_running_loop()
+    # spread the first polls over one interval
+    await asyncio.sleep(random.uniform(0, args.interval))
+    while True:
+        started = loop.time()
+        try:
+            await client.async_query_ecu()
+        except (APSystemsInvalidData, OSError, asyncio.TimeoutError) as err:
+            stats.failures[type(err).__name__] += 1
+            stats.failed_latencies.append(loop.time() - started)
+        except Exception as err:
+            # unexpected, but count it instead of silently losing this ECU
+            stats.failures[f"unexpected {type(err).__name__}"] += 1
+            stats.failed_latencies.append(loop.time() - started)
+        stats.latencies.append(loop.time() - started)
+        stats.polls += 1
+        await asyncio.sleep(max(0.0, args.interval - (loop.time() - started)))
+
+
+async def drive(args):
+    clients = []
+    for i in range(args.ecus):
+        client = APSystemsECU('127.0.0.1', args.base_port + i)
+        client.socket_sleep_time = args.socket_sleep
+        client.timeout = args.timeout
+        clients.append(client)
+
+    stats = SoakStats()
+    tasks = [asyncio.create_task(poll_forever(client, args, stats)) for client in clients]
+    deadline = time.monotonic() + args.duration
+    try:
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(args.report_interval, max(0.0, deadline - time.monotonic())))
+            stats.report(clients)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    stats.summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scale/soak test APSystemsECU against synthetic ECUs on localhost")
+    parser.add_argument("--ecus", type=int, default=100, help="number of synthetic ECUs")
+    parser.add_argument("--inverters", type=int, default=16, help="inverters per ECU")
+    parser.add_argument("--base-port", type=int, default=20000, help="first loopback port, one port per ECU")
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between polls of one ECU")
+    parser.add_argument("--duration", type=float, default=3600.0, help="seconds to run")
+    parser.add_argument("--report-interval", type=float, default=60.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="minimum ECU response latency, seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="fraction of commands that fail")
+    parser.add_argument("--silence", type=float, default=30.0, help="how long a silent ECU holds the connection")
+    parser.add_argument("--refresh", type=float, default=300.0, help="seconds between inverter data updates")
+    parser.add_argument("--socket-sleep", type=float, default=2.0, help="client pause between commands")
+    parser.add_argument("--timeout", type=float, default=5.0, help="client command timeout")
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    servers = multiprocessing.Process(target=run_servers, args=(args, ready), daemon=True)
+    servers.start()
+    ready.wait()
+
+    raise_fd_limit()
+    try:
+        asyncio.run(drive(args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servers.terminate()
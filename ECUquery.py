@@ -4,33 +4,43 @@
 # likely original source:  https://github.com/Doudou14/Domoticz-apsystems_ecu/blob/main/ECU/APSystemsECU.py
 
 import socket
-import binascii
 import datetime
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from pprint import pprint
 
+from APSystemsProtocol import APSystemsProtocol, APSystemsInvalidData
+
 class APSystemsECU:
 
-    def __init__(self, ip_addr, port=8899, raw_ecu=None, raw_inverter=None):
+    def __init__(self, ip_addr, port=8899, raw_ecu=None, raw_inverter=None, trace=None):
         self.ip_addr = ip_addr
         self.port = port
 
+        # command building, framing and parsing live in the sans-IO core,
+        # this class only moves bytes between it and a blocking socket
+        self.protocol = APSystemsProtocol(trace)
+
         self.recv_size = 2048
 
-        self.ecu_query = 'APS1100160001END'
-        self.inverter_query_prefix = 'APS1100280002'
-        self.inverter_query_suffix = 'END'
-        self.inverter_byte_start = 26
+        # how long to wait on socket commands until we get a complete frame
+        self.timeout = 5
+
+        # how long to wait between socket open/closes
+        self.socket_sleep_time = 2.0
 
         self.ecu_id = None
         self.qty_of_inverters = 0
-        self.inverters = []
+        self.inverters = {}
         self.firmware = None
         self.timezone = None
 
         self.ecu_raw_data = raw_ecu
         self.inverter_raw_data = raw_inverter
+        self.inverter_raw_signal = None
 
         self.last_inverter_data = None
 
@@ -41,15 +51,48 @@ class APSystemsECU:
         print(f"TZ : {self.timezone}")
         print(f"Qty of inverters : {self.qty_of_inverters}")
 
-    def query_ecu(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.ip_addr,self.port))
+    def send_read_from_socket(self, cmd):
+        # the ECU likes the socket to be closed and re-opened between commands
+        sock = socket.create_connection((self.ip_addr, self.port), timeout=self.timeout)
+        try:
+            self.protocol.reset()
+            sock.sendall(cmd)
+            while True:
+                frame = self.protocol.next_frame()
+                if frame is not None:
+                    break
+                data = sock.recv(self.recv_size)
+                if data == b'':
+                    raise APSystemsInvalidData("Got empty string from socket")
+                self.protocol.receive_data(data)
+            sock.shutdown(socket.SHUT_RDWR)
+        finally:
+            sock.close()
+        return frame
+
+    def query(self):
+        cycle = self.protocol.query_cycle()
+        cmd = next(cycle)
+        while True:
+            frame = self.send_read_from_socket(cmd)
+            try:
+                cmd = cycle.send(frame)
+            except StopIteration as stop:
+                data = stop.value
+                break
+            time.sleep(self.socket_sleep_time)
+
+        self.ecu_raw_data = self.protocol.ecu_raw_data
+        self.inverter_raw_data = self.protocol.inverter_raw_data
+        self.inverter_raw_signal = self.protocol.inverter_raw_signal
+        self.update_from_ecu(self.protocol.ecu)
+        self.inverters = data["inverters"]
+        self.last_inverter_data = data
 
-        sock.send(self.ecu_query.encode('utf-8'))
-        self.ecu_raw_data = sock.recv(self.recv_size)
+        return(data)
 
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+    def query_ecu(self):
+        self.ecu_raw_data = self.send_read_from_socket(self.protocol.ecu_command())
 
         self.process_ecu_data()
 
@@ -57,225 +100,91 @@ class APSystemsECU:
         if not ecu_id:
             ecu_id = self.ecu_id
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((self.ip_addr,self.port))
-        cmd = self.inverter_query_prefix + self.ecu_id + self.inverter_query_suffix
-        sock.send(cmd.encode('utf-8'))
-
-        self.inverter_raw_data = sock.recv(self.recv_size)
-
-        sock.shutdown(socket.SHUT_RDWR)
-        sock.close()
+        self.inverter_raw_data = self.send_read_from_socket(self.protocol.inverter_command(ecu_id))
 
         data = self.process_inverter_data()
         self.last_inverter_data = data
 
         return(data)
- 
-    def aps_int(self, codec, start):
-        return int(binascii.b2a_hex(codec[(start):(start+2)]),16)
-    
-    def aps_bool(self, codec, start):
-        return bool(binascii.b2a_hex(codec[(start):(start+2)]))
-    
-    def aps_uid(self, codec, start):
-        return str(binascii.b2a_hex(codec[(start):(start+12)]))[2:14]
-    
-    def aps_str(self, codec, start, amount):
-        return str(codec[start:(start+amount)])[2:(amount+2)]
-    
-    def aps_timestamp(self, codec, start, amount):
-        time_str=str(binascii.b2a_hex(codec[start:(start+amount)]))[2:(amount+2)]
-        return time_str[0:4]+"-"+time_str[4:6]+"-"+time_str[6:8]+" "+time_str[8:10]+":"+time_str[10:12]+":"+time_str[12:14]
+
+    def update_from_ecu(self, ecu):
+        self.ecu_id = ecu["ecu_id"]
+        self.qty_of_inverters = ecu["qty_of_inverters"]
+        self.firmware = ecu["ecu_firmware"]
+        self.timezone = ecu["timezone"]
 
     def process_ecu_data(self, data=None):
         if not data:
             data = self.ecu_raw_data
 
-        if len(data) < 16:
-            raise Exception("ECU query didn't return minimum 16 bytes, no inverters active.")
-
-        print(f"ECU data: {data.hex()}")
-        self.ecu_id = self.aps_str(data, 13, 12)
-        self.qty_of_inverters = self.aps_int(data, 46)
-        self.firmware = self.aps_str(data, 55, 15)
-        self.timezone = self.aps_str(data, 70, 9)
+        self.update_from_ecu(self.protocol.process_ecu_data(data))
 
     def process_inverter_data(self, data=None):
         if not data:
             data = self.inverter_raw_data
 
-        print(f"Inverter data: {data.hex()}")
-
-        output = {}
-
-        timestamp = self.aps_timestamp(data, 19, 14)
-        inverter_qty = self.aps_int(data, 17)
-
-        output["timestamp"] = timestamp
-        output["inverter_qty"] = inverter_qty
-        output["inverters"] = []
-
-        # this is the start of the loop of inverters
-        location = self.inverter_byte_start
-
-        inverters = []
-        for i in range(0, inverter_qty):
-
-            inv={}
-
-            inverter_uid = self.aps_uid(data, location)
-            inv["uid"] = inverter_uid
-            location += 6
-
-            inv["online"] = self.aps_bool(data, location)
-            location += 1
-
-            inv["unknown"] = self.aps_str(data, location, 2)
-            location += 2
-
-            inv["AC frequency"] = self.aps_int(data, location) / 10
-            location += 2
-
-            inv["temperature"] = self.aps_int(data, location) - 100
-            location += 2
-
-            # a YC600 starts with 4080
-            if inverter_uid.startswith("4080"):
-                Input_channel_qty = 2
-                (channel_data, location) = self.process_yc600(data, location)
-                inv.update(channel_data)    
-
-            # a QS1 starts with 8020
-            elif inverter_uid.startswith("8020"):
-                Input_channel_qty = 4
-                (channel_data, location) = self.process_qs1(data, location)
-                inv.update(channel_data)    
-
-            # a DS3S starts with 7020
-            elif inverter_uid.startswith("7020"):
-                Input_channel_qty = 2
-                (channel_data, location) = self.process_ds3(data, location)
-                inv.update(channel_data)    
-
-            # a DS3M starts with 7070
-            elif inverter_uid.startswith("7070"):
-                Input_channel_qty = 2
-                (channel_data, location) = self.process_ds3(data, location)
-                inv.update(channel_data)    
-
-            inverters.append(inv)
-
-        total_power = 0
-        for inv in inverters:
-            if "power_dc" in inv:
-                total_power += sum(inv["power_dc"])
-
-        output["total_power (DC)"] = total_power
-        output["inverters"] = inverters
+        output = self.protocol.process_inverter_data(data)
+        self.inverters = output["inverters"]
         return (output)
 
-    def process_qs1(self, data, location):
-
-        power = []
-        voltages = []
-
-        power.append(self.aps_int(data, location))
-        location += 2
-
-        voltage = self.aps_int(data, location)
-        location += 2
-
-        power.append(self.aps_int(data, location))
-        location += 2
-
-        power.append(self.aps_int(data, location))
-        location += 2
-
-        power.append(self.aps_int(data, location))
-        location += 2
-
-        voltages.append(voltage)
-
-        output = {
-            "model" : "QS1",
-            "channel_qty" : 4,
-            "power_DC" : power,
-            "voltage" : voltages
-        }
-
-        return (output, location)
-
-
-    def process_yc600(self, data, location):
-        power = []
-        voltages = []
 
-        for i in range(0, 2):
-            power.append(self.aps_int(data, location))
-            location += 2
-
-            voltages.append(self.aps_int(data, location))
-            location += 2
-
-        output = {
-            "model" : "YC600",
-            "channel_qty" : 2,
-            "power_dc" : power,
-            "voltage" : voltages,
-        }
-
-        return (output, location)
-
-    def process_ds3(self, data, location):
-        power = []
-        voltages = []
-        dc_i = []
-        dc_p = []
-
-        for i in range(0, 2):
-            #Appends the  current value from the data at the current location to the corresponding lists.
-            #Increments the location by 2 to move to the next data point.
-
-            power.append(self.aps_int(data, location))
-            location += 2
-
-            voltages.append(self.aps_int(data, location))
-            location += 2
-
-            dc_i.append(self.aps_int(data, location))
-            location += 2
-
-            #dc_p.append(self.aps_int(data, location))
-            #location += 2
-
-        output = {
-            "model" : "DS3",
-            "channel_qty" : 2,
-            "power_dc" : power,
-            "AC voltage" : voltages
-        }
-
-        return (output, location)
+class APSystemsECUPool:
+    """Poll many ECUs from non-async code on a pool of worker threads."""
+
+    def __init__(self, ecus, port=8899, max_workers=None):
+        # ecus are (ip_addr, port) pairs or plain ip_addrs using port, several
+        # ECUs may share one host (port forwards, proxies)
+        self.ecus = {}
+        for ecu in ecus:
+            (ip_addr, ecu_port) = ecu if isinstance(ecu, tuple) else (ecu, port)
+            self.ecus[(ip_addr, ecu_port)] = APSystemsECU(ip_addr, ecu_port)
+        if not max_workers:
+            # polls mostly wait on the network, but one thread per ECU does
+            # not scale to a large fleet
+            max_workers = min(len(self.ecus), 4 * (os.cpu_count() or 1), 32) or 1
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def query(self):
+        """Query all ECUs concurrently, returns {(ip_addr, port): data or exception}."""
+        futures = {key: self.executor.submit(ecu.query) for key, ecu in self.ecus.items()}
+        results = {}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as err:
+                # one broken ECU must not lose the results of the others
+                results[key] = err
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 if __name__ == "__main__":
 
     # ToDo: enter the correct IP address of ECU below
     ecu = APSystemsECU("192.168.0.248")
+    # to debug raw frames log them at DEBUG level and/or capture them to a file:
+    # from APSystemsProtocol import APSystemsTrace
+    # ecu = APSystemsECU("192.168.0.248", trace=APSystemsTrace(enabled=True, capture_path="frames.txt"))
 
-    # get inverter data by querying the ecu directly
-    ecu.query_ecu()
-    print(ecu.dump())
+    # get ecu and inverter data by querying the ecu directly
+    data = ecu.query()
+    ecu.dump()
     print("*** End ECU data ***")
-    
-    data = ecu.query_inverters()
+
     print(json.dumps(data, indent=2))
 
     # sample_ecu_data   = bytes.fromhex('41505331313030393430303031323136333030303037303034303100004df3000001a900000136d0d0d0d0d0d0d00001000131303031324543555f425f312e322e33333030394574632f474d542d3880971b02db59000000000000454e440a')
     # expect:
     #   ECU : 216300007004
-    #   Firmware : ECU_B_1.2.33009
+    #   Firmware : ECU_B_1.2.33
     #   TZ : Etc/GMT-8
     #   Qty of inverters : 1
 
@@ -284,22 +193,21 @@ if __name__ == "__main__":
     #   "timestamp": "2024-09-13 12:59:32"
 #       "uid": "702000999999",
 #       "online": true,
-#       "unknown": "01",
-#       "AC frequency": 49.9,
+#       "signal": 0,
+#       "frequency": 49.9,
 #       "temperature": 51,
-#       "model": "DS3",
-#       "channel_qty": 2,
-#       "power_dc": [
+#       "model": "YC600/DS3 [-S-M-D-L]",
+#       "MPPT_channel_qty": 2,
+#       "DC_power": [
 #         211,
-#         214    # todo: fix wrong 240
+#         214
 #       ],
-#       "AC voltage": [
+#       "DC_voltage": [
 #         240,
-#         240 # todo: fix wrong
-#       ]
+#         240    # todo: these are AC voltages
+#       ],
+#       "DC_current": []
 #     }
-#   ],
-#   "total_power (DC)": 425     # todo: fix wrong 451
 # }
 
 # todo add: